@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares parse_openurl with parse_qs on resolver queries, on its own and
+as used by Resolved (building it, then openurl_pairs() and oclc_number).
+
+Usage: `python ./benchmark.py [query_log]`, where query_log has one OpenURL
+query string per line (lines starting with # are skipped); by default the
+sample log benchmark_queries.txt next to this file is used.
+"""
+
+import os, sys, timeit
+from urllib.parse import parse_qs
+
+from py360link2 import Resolved, parse_openurl
+
+
+SAMPLE_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_queries.txt')
+
+
+def load_queries(path=SAMPLE_LOG):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def sersol_data(query):
+    """ Minimal get_sersol_data output echoing `query`. """
+    return {
+        'echoedQuery': {'queryString': query, 'library': {'name': 'Brown University'}},
+        'results': [{
+            'format': 'journal',
+            'citation': {'title': 'Evaluating functional localizers', 'creator': 'Berman, Marc G.',
+                         'source': 'NeuroImage', 'volume': '50', 'spage': '56', 'date': '2010',
+                         'doi': '10.1016/j.neuroimage.2009.12.024', 'issn': {'print': '1053-8119'}},
+            'linkGroups': [],
+            }],
+        }
+
+
+class ParseQsResolved(Resolved):
+    """
+    Resolved as it was before parse_openurl: parse_qs in __init__,
+    _retain_ourl_params and openurl_pairs.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.query = data['echoedQuery']['queryString']
+        self.library = data['echoedQuery']['library']['name']
+        self.query_dict = parse_qs(self.query)
+        self.citation = data['results'][0]['citation']
+        self.link_groups = data['results'][0]['linkGroups']
+        self.format = data['results'][0]['format']
+
+    def _retain_ourl_params(self):
+        parsed = parse_qs(self.query)
+        return [(key, parsed[key]) for key in ['rfe_dat', 'rfr_id', 'sid'] if key in parsed]
+
+    def openurl_pairs(self):
+        parse_qs(self.query)
+        return Resolved.openurl_pairs(self)
+
+
+def run(queries, number=1000):
+    datas = [sersol_data(query) for query in queries]
+
+    def time(func):
+        seconds = min(timeit.repeat(func, number=number, repeat=7))
+        return seconds * 1e6 / (number * len(queries))
+
+    def parse(parser):
+        def func():
+            for query in queries:
+                parser(query)
+        return func
+
+    def resolve(cls):
+        def func():
+            for data in datas:
+                resolved = cls(data)
+                resolved.openurl_pairs()
+                resolved.oclc_number
+        return func
+
+    print('%s queries' % len(queries))
+    print('parse_qs:                   %6.1f us/query' % time(parse(parse_qs)))
+    print('parse_openurl:              %6.1f us/query' % time(parse(parse_openurl)))
+    print('Resolved, parse_qs (old):   %6.1f us/query' % time(resolve(ParseQsResolved)))
+    print('Resolved, parse_openurl:    %6.1f us/query' % time(resolve(Resolved)))
+
+
+if __name__ == '__main__':
+    run( load_queries(*sys.argv[1:2]) )
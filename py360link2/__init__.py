@@ -2,3 +2,5 @@
 
 from __future__ import unicode_literals
 from .link360 import *
+from .archive import Link360Archive
+from .openurl import OpenURLContext, parse_openurl
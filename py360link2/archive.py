@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+"""
+Append-only archive of raw 360Link XML responses.
+
+Responses are zlib-compressed and appended to numbered segment files; a
+memory-mapped open-addressing hash table (`index`) maps a normalized query
+to the segment and offset of each response recorded for it.
+"""
+
+import contextlib, hashlib, io, json, logging, mmap, os, struct, time, zlib
+try:
+    import fcntl
+except ImportError:  # not available on Windows; appends there are unlocked
+    fcntl = None
+
+from lxml import etree
+
+from .link360 import Link360Exception, Link360JSON
+
+
+log = logging.getLogger( 'py360link2' )
+
+
+ARCHIVE_MAGIC = b'360A'
+ARCHIVE_VERSION = 2
+#magic, version, capacity, count
+INDEX_HEADER = struct.Struct('>4sIQQ')
+#query hash, timestamp (ms), segment, offset; a zero hash marks an empty slot
+INDEX_SLOT = struct.Struct('>QqIxxxxQ')
+#timestamp (ms), query length, compressed body length, crc32 of query + body; then query, then body
+RECORD_HEADER = struct.Struct('>qIII')
+INITIAL_CAPACITY = 1024
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def normalize_query(query):
+    """
+    Order-independent form of an OpenURL query, used as the archive key.
+    """
+    pairs = [pair for pair in query.lstrip('?').split('&') if pair]
+    return '&'.join(sorted(pairs))
+
+
+def _query_hash(normalized):
+    digest = hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).digest()
+    return struct.unpack('>Q', digest)[0] or 1
+
+
+class Link360Archive(object):
+    """
+    Writer and reader for a directory of archived 360Link responses.
+
+    Pass an archive opened with mode='a' to get_sersol_response or
+    get_sersol_data to record every response fetched. Open with mode='r'
+    to replay them, e.g. as an offline response source:
+
+        archive = Link360Archive('/path/to/archive')
+        data = archive.get_sersol_data(query)
+
+    Several processes may append to one archive at once; each append holds
+    an exclusive lock on the archive's `lock` file (where fcntl is
+    available). A reader sees the responses indexed when it was opened.
+
+    A partial record left by a crash mid-append is truncated the next time
+    the archive is opened for appending.
+    """
+    def __init__(self, path, mode='r', segment_size=SEGMENT_SIZE):
+        if mode not in ('r', 'a'):
+            raise Link360Exception('Archive mode must be "r" or "a", not %r.' % mode)
+        self.path = path
+        self.mode = mode
+        self.segment_size = segment_size
+        self._segment_maps = {}
+        self._writer = None
+        self._writer_segment = None
+        self._lock_file = None
+        index_path = os.path.join(path, 'index')
+        if mode == 'r':
+            if not os.path.exists(index_path):
+                raise Link360Exception('No 360Link archive at %s.' % path)
+            self.segments = self._find_segments()
+            self._open_index()
+            return
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, 'lock'), 'ab')
+        with self._locked():
+            if not os.path.exists(index_path):
+                self._write_index(index_path, [], INITIAL_CAPACITY)
+            self.segments = self._find_segments()
+            self._open_index()
+            self._truncate_torn_tail()
+
+    def _find_segments(self):
+        names = [name for name in os.listdir(self.path) if name.startswith('segment-')]
+        return sorted(int(name[len('segment-'):].split('.')[0]) for name in names)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, 'segment-%05d.dat' % segment)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """ Exclusive lock on the archive; a no-op for readers. """
+        locking = fcntl is not None and self._lock_file is not None
+        if locking:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if locking:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """
+        Catch up with other writers: called with the lock held, before appending.
+        """
+        index_path = os.path.join(self.path, 'index')
+        if os.stat(index_path).st_ino != os.fstat(self._index_file.fileno()).st_ino:
+            #another writer grew (replaced) the index
+            self._close_index()
+            self._open_index()
+        else:
+            _, _, self.capacity, self.count = INDEX_HEADER.unpack_from(self._index)
+        self.segments = self._find_segments()
+        if self._writer is not None and self._writer_segment != self.segments[-1]:
+            self._writer.close()
+            self._writer = None
+
+    ## index
+
+    def _open_index(self):
+        self._index_file = open(os.path.join(self.path, 'index'), 'r+b' if self.mode == 'a' else 'rb')
+        access = mmap.ACCESS_WRITE if self.mode == 'a' else mmap.ACCESS_READ
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=access)
+        magic, version, self.capacity, self.count = INDEX_HEADER.unpack_from(self._index)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            raise Link360Exception('Unsupported 360Link archive index in %s.' % self.path)
+
+    def _close_index(self):
+        self._index.close()
+        self._index_file.close()
+
+    def _write_index(self, index_path, slots, capacity):
+        """
+        Write a fresh table holding `slots`, replacing any existing index.
+        """
+        table = bytearray(INDEX_HEADER.size + capacity * INDEX_SLOT.size)
+        INDEX_HEADER.pack_into(table, 0, ARCHIVE_MAGIC, ARCHIVE_VERSION, capacity, len(slots))
+        for slot in slots:
+            self._insert_slot(table, capacity, slot)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(table)
+        os.replace(tmp_path, index_path)
+
+    def _insert_slot(self, table, capacity, slot):
+        position = slot[0] & (capacity - 1)
+        while INDEX_SLOT.unpack_from(table, INDEX_HEADER.size + position * INDEX_SLOT.size)[0]:
+            position = (position + 1) & (capacity - 1)
+        INDEX_SLOT.pack_into(table, INDEX_HEADER.size + position * INDEX_SLOT.size, *slot)
+
+    def _slots(self, qhash=None):
+        """
+        Occupied slots; with `qhash`, only the probe run for that hash.
+        """
+        if qhash is None:
+            positions = range(self.capacity)
+        else:
+            start = qhash & (self.capacity - 1)
+            positions = ((start + i) & (self.capacity - 1) for i in range(self.capacity))
+        for position in positions:
+            slot = INDEX_SLOT.unpack_from(self._index, INDEX_HEADER.size + position * INDEX_SLOT.size)
+            if not slot[0]:
+                if qhash is None:
+                    continue
+                return
+            if qhash is None or slot[0] == qhash:
+                yield slot
+
+    def _add_to_index(self, slot):
+        if (self.count + 1) * 2 > self.capacity:
+            slots = list(self._slots())
+            self._close_index()
+            self._write_index(os.path.join(self.path, 'index'), slots, self.capacity * 2)
+            self._open_index()
+        self._insert_slot(self._index, self.capacity, slot)
+        self.count += 1
+        INDEX_HEADER.pack_into(self._index, 0, ARCHIVE_MAGIC, ARCHIVE_VERSION, self.capacity, self.count)
+
+    def reindex(self):
+        """
+        Rebuild the index from the segment files, e.g. after a crash
+        between appending a response and indexing it.
+        """
+        if self.mode != 'a':
+            raise Link360Exception('Archive at %s is not open for appending.' % self.path)
+        with self._locked():
+            slots = [(_query_hash(query), timestamp, segment, offset)
+                     for (segment, offset, query, timestamp, _) in self._scan()]
+            capacity = INITIAL_CAPACITY
+            while len(slots) * 2 > capacity:
+                capacity *= 2
+            self._close_index()
+            self._write_index(os.path.join(self.path, 'index'), slots, capacity)
+            self._open_index()
+
+    ## segments
+
+    def append(self, query, body, timestamp=None):
+        """
+        Record a raw response body (bytes) for `query`. Called by
+        get_sersol_response for each response it fetches.
+        """
+        if self.mode != 'a':
+            raise Link360Exception('Archive at %s is not open for appending.' % self.path)
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        normalized = normalize_query(query).encode('utf-8')
+        compressed = zlib.compress(body)
+        crc = zlib.crc32(compressed, zlib.crc32(normalized))
+        record = RECORD_HEADER.pack(timestamp, len(normalized), len(compressed), crc) + normalized + compressed
+        with self._locked():
+            self._refresh()
+            if self._writer is None or self._writer.seek(0, os.SEEK_END) >= self.segment_size:
+                self._open_writer()
+            segment, offset = self._writer_segment, self._writer.seek(0, os.SEEK_END)
+            self._writer.write(record)
+            self._writer.flush()
+            self._add_to_index((_query_hash(normalized.decode('utf-8')), timestamp, segment, offset))
+        return timestamp
+
+    def _open_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+        if not self.segments or os.path.getsize(self._segment_path(self.segments[-1])) >= self.segment_size:
+            self.segments.append(self.segments[-1] + 1 if self.segments else 0)
+        self._writer_segment = self.segments[-1]
+        self._writer = open(self._segment_path(self._writer_segment), 'ab')
+
+    def _truncate_torn_tail(self):
+        """
+        Cut a partial record (from a crash mid-append) off the last segment,
+        so new records are not written after it.
+
+        A damaged record that doesn't run past the end of the file is not a
+        torn tail -- complete records may follow it -- so the segment is left
+        as is and appends roll over to a new, empty segment instead.
+        """
+        if not self.segments:
+            return
+        segment = self.segments[-1]
+        path = self._segment_path(segment)
+        size = os.path.getsize(path)
+        end = 0
+        for (_, end, _, _, _) in self._records(segment):
+            pass
+        if end == size:
+            return
+        segment_map = self._segment_maps.pop(segment, None)
+        if segment_map is not None:
+            segment_map.close()
+        with open(path, 'rb') as f:
+            f.seek(end)
+            header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size or end + RECORD_HEADER.size + sum(RECORD_HEADER.unpack(header)[1:3]) > size:
+            log.warning( 'truncating partial record at %s:%s' % (path, end) )
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+        else:
+            log.error( 'damaged record at %s:%s is not at the end of the segment; appending to a new segment' % (path, end) )
+            self.segments.append(segment + 1)
+            open(self._segment_path(segment + 1), 'ab').close()
+
+    def _segment_map(self, segment, end):
+        """
+        Read-only map of a segment covering at least `end` bytes; remapped
+        when the segment has grown since it was last mapped.
+        """
+        segment_map = self._segment_maps.get(segment)
+        if segment_map is None or len(segment_map) < end:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._segment_maps[segment] = segment_map
+        return segment_map
+
+    def _read_record(self, segment, offset):
+        """
+        (query, timestamp, compressed body, end offset) of the record at
+        `offset`, or None if it is cut short or fails its checksum.
+        """
+        start = offset + RECORD_HEADER.size
+        segment_map = self._segment_map(segment, start)
+        if len(segment_map) < start:
+            return None
+        timestamp, query_length, body_length, crc = RECORD_HEADER.unpack_from(segment_map, offset)
+        if not query_length or not body_length:
+            #never written by append; e.g. a zero-filled hole, whose crc32 would match
+            return None
+        end = start + query_length + body_length
+        segment_map = self._segment_map(segment, end)
+        if len(segment_map) < end:
+            return None
+        query = segment_map[start:start + query_length]
+        compressed = segment_map[start + query_length:end]
+        if zlib.crc32(compressed, zlib.crc32(query)) != crc:
+            return None
+        return query.decode('utf-8'), timestamp, compressed, end
+
+    def _records(self, segment):
+        """
+        (offset, end, query, timestamp, compressed body) for each record in
+        a segment, stopping at the first one that is damaged.
+        """
+        size = os.path.getsize(self._segment_path(segment))
+        offset = 0
+        while offset < size:
+            record = self._read_record(segment, offset)
+            if record is None:
+                log.warning( 'damaged record at %s:%s; skipping the rest of the segment' % (self._segment_path(segment), offset) )
+                return
+            query, timestamp, compressed, end = record
+            yield offset, end, query, timestamp, compressed
+            offset = end
+
+    def _scan(self):
+        for segment in self._find_segments():
+            for (offset, _, query, timestamp, compressed) in self._records(segment):
+                yield segment, offset, query, timestamp, compressed
+
+    ## reading
+
+    def timestamps(self, query):
+        """
+        Timestamps (ms since the epoch) of the responses recorded for `query`, oldest first.
+        """
+        normalized = normalize_query(query)
+        return sorted(timestamp for (timestamp, _, _) in self._lookup(normalized))
+
+    def _lookup(self, normalized):
+        for (_, timestamp, segment, offset) in self._slots(_query_hash(normalized)):
+            record = self._read_record(segment, offset)
+            if record is not None and record[0] == normalized:
+                yield timestamp, record[0], record[2]
+
+    def get(self, query, timestamp=None):
+        """
+        Raw response body recorded for `query` at `timestamp`, or the most
+        recent one if no timestamp is given. Returns None if there is none.
+        """
+        found = None
+        for (found_timestamp, _, compressed) in self._lookup(normalize_query(query)):
+            if timestamp is not None and found_timestamp != timestamp:
+                continue
+            if found is None or found_timestamp > found[0]:
+                found = (found_timestamp, compressed)
+        if found is None:
+            return None
+        return zlib.decompress(found[1])
+
+    def get_sersol_response(self, query, timestamp=None):
+        """
+        Offline stand-in for link360.get_sersol_response.
+        """
+        body = self.get(query, timestamp)
+        if body is None:
+            raise Link360Exception('No archived 360Link response for %s.' % query)
+        return etree.parse( io.BytesIO(body) )
+
+    def get_sersol_data(self, query, timestamp=None):
+        """
+        Offline stand-in for link360.get_sersol_data.
+        """
+        return _plain( Link360JSON(self.get_sersol_response(query, timestamp)).convert() )
+
+    def __iter__(self):
+        """
+        Sequential scan of every recorded (query, timestamp, body), in the
+        order they were appended. `query` is the normalized query.
+        """
+        for (_, _, query, timestamp, compressed) in self._scan():
+            yield query, timestamp, zlib.decompress(compressed)
+
+    def iter_sersol_data(self):
+        """
+        Re-convert every recorded response with Link360JSON, yielding
+        (query, timestamp, data).
+        """
+        for (query, timestamp, body) in self:
+            yield query, timestamp, _plain( Link360JSON(etree.parse(io.BytesIO(body))).convert() )
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for segment_map in self._segment_maps.values():
+            segment_map.close()
+        self._segment_maps = {}
+        self._close_index()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    ## end class Link360Archive
+
+
+def _plain(data):
+    """ Same json round trip as get_sersol_data, dropping lxml string types. """
+    return json.loads( json.dumps(data) )
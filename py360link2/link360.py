@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 
 
-import json, io, logging, pprint, re, sys, urllib
+import json, io, logging, marshal, pprint, re, struct, sys, urllib
 assert sys.version_info.major > 2
-from urllib.parse import parse_qs
 
 import requests
 from lxml import etree
 
+from .openurl import OpenURLContext, parse_openurl
+
 
 #Added to avoid the following errors:
 #Cannot convert lxml.etree._RotatingErrorLog to lxml.etree._BaseErrorLog
@@ -79,6 +80,13 @@ SERSOL_MAP = {
     }
 }
 
+#Header for the packed (binary) form of sersol data and Resolved objects.
+#Bump SERSOL_PACK_VERSION whenever the packed layout changes.
+SERSOL_PACK_MAGIC = b'360L'
+SERSOL_PACK_VERSION = 2
+SERSOL_PACK_HEADER = struct.Struct('>4sBBc')
+
+
 class Link360Exception(Exception):
     def __init__self(self, message, Errors):
         #http://stackoverflow.com/questions/1319615/proper-way-to-declare-custom-exceptions-in-modern-python
@@ -86,36 +94,54 @@ class Link360Exception(Exception):
         self.Errors = Errors
 
 
-def get_sersol_response(query, key, timeout):
+def get_sersol_response(query, key, timeout, archive=None):
     """
     Get the SerSol API response and parse it into an etree.
+
+    If an `archive` (a Link360Archive opened for appending) is given, the
+    raw response body is recorded in it.
     """
     if key is None:
         raise Link360Exception('Serial Solutions 360Link XML API key is required.')
 
+    url = _sersol_url(query, key)
+    r = requests.get( url )
+    if archive is not None:
+        archive.append( query, r.content )
+    # filelike_obj = StringIO.StringIO( r.content )
+    filelike_obj = io.BytesIO( r.content )
+    doc = etree.parse( filelike_obj )
+    return doc
+
+
+def _sersol_url(query, key):
+    """
+    The 360Link request url: the query exactly as given, followed by the
+    1.0 keys that upconverting a 0.1 query adds (and url_ver, if missing).
+    """
     required_url_elements = {}
     required_url_elements['version'] = '1.0'
-    required_url_elements['url_ver'] = 'Z39.88-2004'
     #Go get the 360link response
     #Base 360Link url
     base_url = "http://%s.openurl.xml.serialssolutions.com/openurlxml?" % key
     # base_url += urllib.urlencode(required_url_elements)  # python2
     base_url += urllib.parse.urlencode( required_url_elements )
     url = base_url + '&%s' % query.lstrip('?')
-    r = requests.get( url )
-    # filelike_obj = StringIO.StringIO( r.content )
-    filelike_obj = io.BytesIO( r.content )
-    doc = etree.parse( filelike_obj )
-    return doc
+    #Values that weren't valid utf-8 can't be upconverted faithfully; the raw originals still go out.
+    added = [ (k, v) for (k, v) in parse_openurl( query ).added if '\ufffd' not in v ]
+    if added:
+        url += '&%s' % urllib.parse.urlencode( added )
+    return url
 
 
-def get_sersol_data(query, key=None, timeout=5):
+def get_sersol_data(query, key=None, timeout=5, archive=None):
     """
     Get and process the data from the API and store in Python dictionary.
     If you would like to cache the 360Link responses, this is data structure
     that you would like to cache.
 
-    Specify a timeout for the http request to 360Link.
+    Specify a timeout for the http request to 360Link, and optionally an
+    `archive` to record the raw response in (see get_sersol_response).
 
     Conversion to and from json is because `data` contains lxml _ElementStringResult elements,
     which can cause pickling problems.
@@ -123,7 +149,7 @@ def get_sersol_data(query, key=None, timeout=5):
     log.debug( 'starting get_sersol_data()' )
     if query is None:
         raise Link360Exception('OpenURL query required.')
-    doc = get_sersol_response(query, key, timeout)
+    doc = get_sersol_response(query, key, timeout, archive)
     data = Link360JSON(doc).convert()
     log.debug( 'data, ```%s```' % pprint.pformat(data) )
     jsn = json.dumps( data )
@@ -132,6 +158,63 @@ def get_sersol_data(query, key=None, timeout=5):
     return jdct
 
 
+def _pack(kind, obj):
+    """
+    Header, then the marshalled object.
+
+    marshal writes a back-reference for any object it has already seen, so
+    repeated keys that share one string object (`holdingData`, `providerName`,
+    etc. -- json.loads memoizes keys, and Link360JSON uses literals) are
+    stored once.
+    """
+    try:
+        payload = marshal.dumps(obj, marshal.version)
+    except ValueError:
+        #Raw Link360JSON output holds lxml string subclasses; normalize as get_sersol_data does.
+        payload = marshal.dumps(json.loads(json.dumps(obj)), marshal.version)
+    header = SERSOL_PACK_HEADER.pack(SERSOL_PACK_MAGIC, SERSOL_PACK_VERSION, marshal.version, kind)
+    return header + payload
+
+
+def _unpack(kind, blob):
+    if len(blob) < SERSOL_PACK_HEADER.size:
+        raise Link360Exception('Packed sersol data is truncated.')
+    magic, version, marshal_version, found_kind = SERSOL_PACK_HEADER.unpack_from(blob)
+    if magic != SERSOL_PACK_MAGIC:
+        raise Link360Exception('Not packed sersol data.')
+    if version != SERSOL_PACK_VERSION or marshal_version > marshal.version:
+        raise Link360Exception('Unsupported packed sersol data version %s/%s.' % (version, marshal_version))
+    if found_kind != kind:
+        raise Link360Exception('Packed sersol data has kind %r, expected %r.' % (found_kind, kind))
+    try:
+        return marshal.loads(blob[SERSOL_PACK_HEADER.size:])
+    except (EOFError, ValueError, TypeError) as e:
+        raise Link360Exception('Packed sersol data is corrupt: %s' % e)
+
+
+def pack_sersol_data(data):
+    """
+    Compact binary form of the dictionary from get_sersol_data (or
+    Link360JSON.convert) for caching or handing to worker processes.
+    Smaller and several times faster to round trip than json.
+
+    Meant for short-lived caches; only unpack data you packed yourself.
+    """
+    return _pack(b'D', data)
+
+
+def unpack_sersol_data(blob):
+    """
+    Inverse of pack_sersol_data.
+    """
+    return _unpack(b'D', blob)
+
+
+def _copy_params(params):
+    """ Own copy of parsed query params, so callers can't alter a shared OpenURLContext. """
+    return dict( (key, list(values)) for (key, values) in params.items() )
+
+
 class Link360JSON(object):
     """
     Convert Link360 XML To JSON
@@ -174,7 +257,7 @@ class Link360JSON(object):
                     pass
                 elif type( element ) == etree._ElementUnicodeResult:
                     pass
-                elif type( element ) == etree._ElementStringResult:
+                elif isinstance( element, bytes ):  # etree._ElementStringResult, which lxml 5+ no longer has
                     element = element.decode( 'utf-8' )
                 elif type( element ) == etree._Element:
                     log.debug( 'hmmm, how to handle type(element), ```%s```?' % type(element) )
@@ -284,7 +367,8 @@ class Resolved(object):
         self.data = data;                                           assert type(self.data) == dict, type(self.data)
         self.query = data['echoedQuery']['queryString'];            assert type(self.query) == str, type(self.query)
         self.library = data['echoedQuery']['library']['name'];      assert type(self.library) == str, type(self.library)
-        self.query_dict = parse_qs(self.query);            assert type(self.query_dict) == dict, type(self.query_dict)
+        self.context = parse_openurl(self.query);                   assert type(self.context) == OpenURLContext, type(self.context)
+        self.query_dict = _copy_params(self.context.params);        assert type(self.query_dict) == dict, type(self.query_dict)
         error = self.data.get('diagnostics', None);                 assert type(error) == str or error is None, type(error)
         if error:
             msg = ' '.join([e.get('message') for e in error if e])
@@ -294,6 +378,45 @@ class Resolved(object):
         self.link_groups = data['results'][0]['linkGroups'];        assert type(self.link_groups) == list, type(self.link_groups)
         self.format = data['results'][0]['format'];                 assert type(self.format) == str, type(self.format)
 
+    def __getstate__(self):
+        """
+        Keep only the source data and the decoded query pairs; the rest is
+        re-derived cheaply in __setstate__ without re-parsing the query.
+        """
+        return {
+            'version': SERSOL_PACK_VERSION,
+            'data': self.data,
+            'query_pairs': self.context.pairs,
+        }
+
+    def __setstate__(self, state):
+        if state.get('version') != SERSOL_PACK_VERSION:
+            raise Link360Exception('Unsupported Resolved state version %s.' % state.get('version'))
+        data = state['data']
+        self.data = data
+        self.query = data['echoedQuery']['queryString']
+        self.library = data['echoedQuery']['library']['name']
+        self.context = OpenURLContext([tuple(pair) for pair in state['query_pairs']])
+        self.query_dict = _copy_params(self.context.params)
+        self.citation = data['results'][0]['citation']
+        self.link_groups = data['results'][0]['linkGroups']
+        self.format = data['results'][0]['format']
+
+    def pack(self):
+        """
+        Compact binary form of this object; see pack_sersol_data.
+        """
+        return _pack(b'R', self.__getstate__())
+
+    @classmethod
+    def unpack(cls, blob):
+        """
+        Rebuild a Resolved object from Resolved.pack output.
+        """
+        resolved = cls.__new__(cls)
+        resolved.__setstate__(_unpack(b'R', blob))
+        return resolved
+
     @property
     def openurl(self):
         return urllib.parse.urlencode( self.openurl_pairs(), doseq=True )
@@ -356,31 +479,8 @@ class Resolved(object):
         retain = ['rfe_dat', 'rfr_id', 'sid']
         assert type(self.query) == str
         log.debug( 'self.query, ```%s```' % self.query )
-        # query8 = self.query.encode( 'utf-8' )
-        # log.debug( 'query8, ```%s```' % query8 )
-        # parsed = parse_qs( query8 )
-        parsed = parse_qs( self.query )
-        assert type( parsed ) == dict
-        log.debug( 'parsed, ```%s```' % pprint.pformat(parsed) )
-        out = []
-        for key in retain:
-            assert type(key) == str, type(key)
-            # key = key.decode( 'utf-8' )
-            val = parsed.get( key, None )
-            log.debug( 'initial val, ```%s```' % pprint.pformat(val) )
-            assert type(val) == str or val is None or type(val) == list, type(val)
-            if val:
-                if type(val) == str:
-                    # new_val = val.decode( 'utf-8' )
-                    new_val = val
-                elif type(val) == list:
-                    new_val = []
-                    # for element8 in val:
-                    #     new_val.append( element8.decode('utf-8') )
-                    for element in val:
-                        assert type(element) == str or val is None, type(val)
-                        new_val.append( element )
-                out.append( (key, new_val) )
+        #Copy the value lists so callers can't alter the shared context.
+        out = [ (key, list(val)) for (key, val) in self.context.retained(retain) ]
         log.debug( 'out, ```%s```' % out )
         return out
 
@@ -428,14 +528,9 @@ class Resolved(object):
 
         See http://ocoins.info/cobg.html for implementation guidelines.
         """
-        query = parse_qs(self.query)  # creates a dct
         format = self.format
-        #Pop invalid rft_id from OCLC
-        try:
-            if query['rft_id'][0].startswith('info:oclcnum'):
-                del query['rft_id']
-        except KeyError:
-            pass
+        #The original query's rft_ids (including invalid info:oclcnum ones from OCLC)
+        #are not passed on; identifiers come from the citation below.
         #Massage the citation into an OpenURL
         #Using a list of tuples here to account for the possiblity of repeating values.
         out = []
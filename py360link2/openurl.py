@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+OpenURL KEV parsing, with OpenURL 0.1 keys upconverted to 1.0 (Z39.88-2004).
+
+Resolver queries often mix the two, e.g. FirstSearch sends `genre=`/`title=`
+alongside `rft.genre=`/`rft.btitle=`; parse_openurl() reads a query once and
+returns an OpenURLContext that callers share instead of re-running parse_qs.
+"""
+
+import functools, urllib
+from urllib.parse import unquote_plus
+
+
+#0.1 keys carried over as 1.0 referent metadata (rft.<key>), unless already given.
+OPENURL_01_KEYS = (
+    'genre', 'aulast', 'aufirst', 'auinit', 'auinit1', 'auinitm', 'au',
+    'atitle', 'stitle', 'issn', 'eissn', 'coden', 'sici', 'isbn', 'bici',
+    'volume', 'issue', 'part', 'spage', 'epage', 'pages', 'artnum', 'date',
+    'quarter', 'ssn', 'pub', 'place', 'edition',
+    )
+
+#0.1 `id=<namespace>:<value>` becomes 1.0 `rft_id=info:<namespace>/<value>`.
+OPENURL_01_ID_NAMESPACES = ('doi', 'pmid', 'oclcnum', 'bibcode', 'arxiv', 'hdl')
+
+#Genres that get the book metadata format; everything else is treated as a journal.
+BOOK_GENRES = ('book', 'bookitem', 'conference', 'proceeding', 'report', 'document')
+BOOK_FORMAT = 'info:ofi/fmt:kev:mtx:book'
+JOURNAL_FORMAT = 'info:ofi/fmt:kev:mtx:journal'
+
+
+def _split(query):
+    """
+    Decode a query into (key, value) pairs, as parse_qs would: blank values
+    and fields without `=` are dropped.
+    """
+    pairs = []
+    for field in query.lstrip('?').split('&'):
+        key, sep, value = field.partition('=')
+        if not value:
+            continue
+        if '%' in key or '+' in key:
+            key = unquote_plus(key)
+        if '%' in value or '+' in value:
+            value = unquote_plus(value)
+        pairs.append((key, value))
+    return pairs
+
+
+def parse_openurl(query):
+    """
+    Parse an OpenURL 0.1 or 1.0 KEV query string into an OpenURLContext.
+    """
+    return OpenURLContext(_split(query))
+
+
+def _upconversion(params):
+    """
+    (key, value) pairs that 0.1 to 1.0 upconversion derives from `params`,
+    whether or not the query already has them.
+    """
+    for key in OPENURL_01_KEYS:
+        for value in params.get(key, ()):
+            yield 'rft.%s' % key, value
+    format = params.get('rft_val_fmt', [None])[0]
+    genre = params.get('rft.genre', params.get('genre', [None]))[0]
+    if format is None and genre:
+        format = BOOK_FORMAT if genre.lower() in BOOK_GENRES else JOURNAL_FORMAT
+        yield 'rft_val_fmt', format
+    #0.1 `title` is the journal or book title, depending on the format;
+    #without a genre, leave it as a plain title for the resolver to sort out.
+    title_key = {BOOK_FORMAT: 'btitle', JOURNAL_FORMAT: 'jtitle'}.get(format, 'title')
+    for value in params.get('title', ()):
+        yield 'rft.%s' % title_key, value
+    for value in params.get('id', ()):
+        namespace, sep, identifier = value.partition(':')
+        namespace = namespace.lower()
+        if identifier and namespace in OPENURL_01_ID_NAMESPACES:
+            yield 'rft_id', 'info:%s/%s' % (namespace, identifier)
+    for value in params.get('sid', ()):
+        yield 'rfr_id', 'info:sid/%s' % value
+    for value in params.get('pid', ()):
+        yield 'rft_dat', value
+
+
+class OpenURLContext(object):
+    """
+    Structured form of one OpenURL query.
+
+    `pairs` and `params` hold the query as given (`params` is shaped like
+    parse_qs output). `added` holds the pairs 0.1 to 1.0 upconversion adds,
+    and url_ver if it was missing. `referent`, `identifiers`, `referrer` and
+    `format` are the 1.0 view of the query plus `added`; `format` is None
+    when the query gives neither rft_val_fmt nor a genre. These are worked
+    out on first use, so callers that only need `params` don't pay for them.
+    """
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.params = _params(pairs)
+        is_1_0 = 'Z39.88-2004' in self.params.get('url_ver', ()) or 'Z39.88-2004' in self.params.get('ctx_ver', ())
+        self.version = '1.0' if is_1_0 else '0.1'
+
+    @functools.cached_property
+    def added(self):
+        added = [] if self.version == '1.0' else self._upconvert()
+        if 'url_ver' not in self.params:
+            added.insert(0, ('url_ver', 'Z39.88-2004'))
+        return added
+
+    @functools.cached_property
+    def _full(self):
+        return _params(self.pairs + self.added) if self.added else self.params
+
+    @functools.cached_property
+    def referent(self):
+        return dict((key[4:], list(values)) for (key, values) in self._full.items() if key.startswith('rft.'))
+
+    @functools.cached_property
+    def identifiers(self):
+        return list(self._full.get('rft_id', ()))
+
+    @functools.cached_property
+    def referrer(self):
+        return list(self._full.get('rfr_id', ()))
+
+    @functools.cached_property
+    def format(self):
+        return self._full.get('rft_val_fmt', [None])[0]
+
+    def _upconvert(self):
+        params, added = self.params, []
+        for (key, value) in _upconversion(params):
+            if key in ('rft_id', 'rfr_id'):
+                #repeatable; add each identifier once
+                if value in params.get(key, ()) or (key, value) in added:
+                    continue
+            elif key in params:
+                continue
+            added.append((key, value))
+        return added
+
+    def retained(self, keys):
+        """
+        (key, values) for each of `keys` present in the query, leaving out
+        values upconversion would derive from its 0.1 keys; so an echoed,
+        upconverted query doesn't pass on e.g. both sid and the added rfr_id.
+        """
+        derived = set(_upconversion(self.params))
+        out = []
+        for key in keys:
+            values = [value for value in self.params.get(key, ()) if (key, value) not in derived]
+            if values:
+                out.append((key, values))
+        return out
+
+    def kev(self):
+        """
+        The query, upconverted to OpenURL 1.0, as a KEV string.
+        """
+        return urllib.parse.urlencode(self.pairs + self.added)
+
+    ## end class OpenURLContext
+
+
+def _params(pairs):
+    params = {}
+    for (key, value) in pairs:
+        params.setdefault(key, []).append(value)
+    return params
@@ -7,7 +7,7 @@ For these to run, a Serial Solutions 360Link XML API key must be
 supplied.
 """
 
-import logging, os, pprint, sys, unittest
+import json, logging, os, pickle, pprint, shutil, sys, tempfile, unittest
 from urllib.parse import parse_qs
 
 logging.basicConfig(
@@ -18,10 +18,14 @@ log = logging.getLogger( 'py360link2' )
 
 try:
     from py360link2 import get_sersol_data, Resolved
+    from py360link2 import Link360Archive, Link360Exception, pack_sersol_data, unpack_sersol_data, parse_openurl
+    from py360link2.link360 import _sersol_url
 except:
     log.exception( 'exception on import follows, but is handled' )
     sys.path.append( '../' )  # accessed when running, eg, `python ./openurl.py TestFromOpenURL.test_unicode_dump`
     from py360link2 import get_sersol_data, Resolved
+    from py360link2 import Link360Archive, Link360Exception, pack_sersol_data, unpack_sersol_data, parse_openurl
+    from py360link2.link360 import _sersol_url
 
 
 #A 360Link API key needs to be specified here.
@@ -199,6 +203,274 @@ class TestUnicodeOpenUrlLookup( unittest.TestCase ):
 
 
 
+#Canned get_sersol_data output, for tests that don't need to hit 360Link.
+SAMPLE_DATA = json.loads( json.dumps( {
+    'version': '1.0',
+    'echoedQuery': {
+        'queryString': 'rft_id=info:doi/10.1016/j.neuroimage.2009.12.024&sid=FirstSearch:WorldCat&rfe_dat=<accessionnumber>17803510</accessionnumber>&url_ver=Z39.88-2004&version=1.0',
+        'timeStamp': '2010-03-09T10:51:42-05:00',
+        'library': { 'name': 'Brown University', 'id': 'RBN' } },
+    'dbDate': '2010-03-09',
+    'results': [ {
+        'format': 'journal',
+        'citation': {
+            'title': 'Evaluating functional localizers: The case of the FFA',
+            'creator': 'Berman, Marc G.',
+            'source': 'NeuroImage',
+            'date': '2010',
+            'volume': '50',
+            'spage': '56',
+            'doi': '10.1016/j.neuroimage.2009.12.024',
+            'issn': { 'print': '1053-8119' },
+            'eissn': '1095-9572',
+            'isbn': [] },
+        'linkGroups': [ {
+            'type': 'holding',
+            'holdingData': {
+                'providerId': 'PRVESC',
+                'providerName': 'Elsevier',
+                'databaseId': 'AAGJG',
+                'databaseName': 'ScienceDirect Journals',
+                'startDate': '1995-01-01' },
+            'url': {
+                'journal': 'http://www.sciencedirect.com/science/journal/10538119',
+                'article': 'http://dx.doi.org/10.1016/j.neuroimage.2009.12.024' } } ] } ] } ) )
+
+
+class TestPack( unittest.TestCase ):
+    """ Checks the binary and pickle forms; no 360Link request needed. """
+
+    def setUp(self):
+        self.sersol = Resolved( SAMPLE_DATA )
+
+    def test_sersol_data_round_trip(self):
+        blob = pack_sersol_data( SAMPLE_DATA )
+        self.assertEqual( unpack_sersol_data(blob), SAMPLE_DATA )
+        self.assertTrue( len(blob) < len(json.dumps(SAMPLE_DATA)) )
+
+    def test_resolved_round_trip(self):
+        for restored in [ Resolved.unpack(self.sersol.pack()), pickle.loads(pickle.dumps(self.sersol)) ]:
+            self.assertEqual( restored.data, self.sersol.data )
+            self.assertEqual( restored.query_dict, self.sersol.query_dict )
+            self.assertEqual( restored.library, 'Brown University' )
+            self.assertEqual( restored.format, 'journal' )
+            self.assertEqual( restored.citation['volume'], '50' )
+            self.assertEqual( restored.oclc_number, '17803510' )
+            self.assertEqual( restored.openurl, self.sersol.openurl )
+
+    def test_bad_blob(self):
+        with self.assertRaises( Link360Exception ):
+            unpack_sersol_data( b'not packed' )
+        with self.assertRaises( Link360Exception ):
+            unpack_sersol_data( self.sersol.pack() )  # a Resolved blob is not plain data
+        blob = pack_sersol_data( SAMPLE_DATA )
+        with self.assertRaises( Link360Exception ):
+            unpack_sersol_data( blob[:20] )  # truncated payload
+        with self.assertRaises( Link360Exception ):
+            unpack_sersol_data( blob[:10] + b'\xff' * 20 )  # garbage after the header
+
+
+SAMPLE_XML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<ssopenurl:openURLResponse xmlns:ssopenurl="http://xml.serialssolutions.com/ns/openurl/v1.0" xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <ssopenurl:version>1.0</ssopenurl:version>
+  <ssopenurl:echoedQuery timeStamp="2010-03-09T10:51:42-05:00">
+    <ssopenurl:queryString>id=pmid:19282400&amp;sid=Entrez:PubMed</ssopenurl:queryString>
+    <ssopenurl:library id="RBN"><ssopenurl:name>Brown University</ssopenurl:name></ssopenurl:library>
+  </ssopenurl:echoedQuery>
+  <ssopenurl:results dbDate="2010-03-09">
+    <ssopenurl:result format="journal">
+      <ssopenurl:citation>
+        <dc:title>%s</dc:title>
+        <ssopenurl:volume>34</ssopenurl:volume>
+        <ssopenurl:issn type="print">1753-1934</ssopenurl:issn>
+      </ssopenurl:citation>
+      <ssopenurl:linkGroups>
+        <ssopenurl:linkGroup type="holding">
+          <ssopenurl:holdingData>
+            <ssopenurl:providerId>PRVSAGE</ssopenurl:providerId>
+            <ssopenurl:providerName>SAGE</ssopenurl:providerName>
+            <ssopenurl:databaseId>SAGE</ssopenurl:databaseId>
+            <ssopenurl:databaseName>SAGE Journals</ssopenurl:databaseName>
+          </ssopenurl:holdingData>
+          <ssopenurl:url type="journal">http://jhs.sagepub.com</ssopenurl:url>
+        </ssopenurl:linkGroup>
+      </ssopenurl:linkGroups>
+    </ssopenurl:result>
+  </ssopenurl:results>
+</ssopenurl:openURLResponse>'''
+
+
+class TestArchive( unittest.TestCase ):
+    """ Checks recording and replaying raw responses; no 360Link request needed. """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.path )
+
+    def test_append_and_get(self):
+        with Link360Archive( self.path, mode='a' ) as archive:
+            archive.append( 'sid=x&id=pmid:1', SAMPLE_XML % b'first', timestamp=1000 )
+            archive.append( 'id=pmid:1&sid=x', SAMPLE_XML % b'second', timestamp=2000 )
+            archive.append( 'id=pmid:2', SAMPLE_XML % b'other', timestamp=1500 )
+        with Link360Archive( self.path ) as archive:
+            self.assertEqual( len(archive), 3 )
+            self.assertEqual( archive.timestamps('?id=pmid:1&sid=x'), [1000, 2000] )
+            self.assertEqual( archive.get('id=pmid:1&sid=x'), SAMPLE_XML % b'second' )  # most recent
+            self.assertEqual( archive.get('id=pmid:1&sid=x', timestamp=1000), SAMPLE_XML % b'first' )
+            self.assertEqual( archive.get('id=pmid:3'), None )
+            doc = archive.get_sersol_response( 'id=pmid:2' )
+            self.assertEqual( doc.xpath('//dc:title/text()', namespaces={'dc': 'http://purl.org/dc/elements/1.1/'}), ['other'] )
+            self.assertEqual( [ timestamp for (query, timestamp, body) in archive ], [1000, 2000, 1500] )
+            with self.assertRaises( Link360Exception ):
+                archive.append( 'id=pmid:4', SAMPLE_XML )
+
+    def test_iter_sersol_data(self):
+        """ Bulk re-conversion of recorded responses, through to Resolved. """
+        with Link360Archive( self.path, mode='a' ) as archive:
+            archive.append( 'id=pmid:1', SAMPLE_XML % b'first', timestamp=1000 )
+            archive.append( 'id=pmid:2', SAMPLE_XML % b'second', timestamp=2000 )
+        with Link360Archive( self.path ) as archive:
+            converted = list( archive.iter_sersol_data() )
+            self.assertEqual( [ (query, timestamp) for (query, timestamp, data) in converted ], [('id=pmid:1', 1000), ('id=pmid:2', 2000)] )
+            sersol = Resolved( converted[1][2] )
+            self.assertEqual( sersol.citation['title'], 'second' )
+            self.assertEqual( sersol.citation['issn'], {'print': '1753-1934'} )
+            self.assertEqual( sersol.link_groups[0]['holdingData']['providerName'], 'SAGE' )
+            self.assertEqual( archive.get_sersol_data('id=pmid:1'), converted[0][2] )
+
+    def test_torn_record(self):
+        """ A partial record from a crash mid-append is skipped, then truncated. """
+        with Link360Archive( self.path, mode='a' ) as archive:
+            archive.append( 'id=pmid:1', SAMPLE_XML % b'first', timestamp=1000 )
+            segment_path = archive._segment_path( archive.segments[-1] )
+        with open( segment_path, 'ab' ) as f:
+            f.write( b'\x00' * 10 )
+        with Link360Archive( self.path ) as archive:
+            self.assertEqual( [ timestamp for (query, timestamp, body) in archive ], [1000] )
+        with Link360Archive( self.path, mode='a' ) as archive:
+            archive.append( 'id=pmid:2', SAMPLE_XML % b'second', timestamp=2000 )
+            self.assertEqual( [ timestamp for (query, timestamp, body) in archive ], [1000, 2000] )
+            archive.reindex()
+            self.assertEqual( len(archive), 2 )
+            self.assertEqual( archive.get('id=pmid:2'), SAMPLE_XML % b'second' )
+
+    def test_damaged_record_mid_segment(self):
+        """ Complete records after a damaged one are kept; appends move to a new segment. """
+        with Link360Archive( self.path, mode='a' ) as archive:
+            for i in range( 3 ):
+                archive.append( 'id=pmid:%s' % i, SAMPLE_XML % str(i).encode('utf-8'), timestamp=i )
+            segment_path = archive._segment_path( archive.segments[-1] )
+        size = os.path.getsize( segment_path )
+        with open( segment_path, 'r+b' ) as f:
+            f.seek( size // 2 )  # inside the second record
+            byte = f.read( 1 )
+            f.seek( size // 2 )
+            f.write( bytes([byte[0] ^ 0xff]) )
+        with Link360Archive( self.path, mode='a' ) as archive:
+            self.assertEqual( os.path.getsize(segment_path), size )
+            self.assertEqual( archive.get('id=pmid:2'), SAMPLE_XML % b'2' )  # still indexed and readable
+            archive.append( 'id=pmid:3', SAMPLE_XML % b'3', timestamp=3 )
+            self.assertEqual( len(archive.segments), 2 )
+            self.assertEqual( archive.get('id=pmid:3'), SAMPLE_XML % b'3' )
+
+    def test_reader_cannot_reindex(self):
+        Link360Archive( self.path, mode='a' ).close()
+        with Link360Archive( self.path ) as archive:
+            with self.assertRaises( Link360Exception ):
+                archive.reindex()
+
+    def test_two_writers(self):
+        """ Writers sharing an archive see each other's appends, including index growth. """
+        with Link360Archive( self.path, mode='a' ) as first, Link360Archive( self.path, mode='a' ) as second:
+            for i in range( 1200 ):
+                ( first if i % 2 else second ).append( 'id=pmid:%s' % i, SAMPLE_XML % str(i).encode('utf-8'), timestamp=i )
+        with Link360Archive( self.path ) as archive:
+            self.assertEqual( len(archive), 1200 )
+            self.assertEqual( [ timestamp for (query, timestamp, body) in archive ], list(range(1200)) )
+            for i in [ 0, 601, 1199 ]:
+                self.assertEqual( archive.get('id=pmid:%s' % i), SAMPLE_XML % str(i).encode('utf-8') )
+
+    def test_growth_and_reindex(self):
+        with Link360Archive( self.path, mode='a', segment_size=4096 ) as archive:
+            for i in range( 1500 ):
+                archive.append( 'id=pmid:%s' % i, SAMPLE_XML % str(i).encode('utf-8'), timestamp=i )
+            self.assertTrue( len(archive.segments) > 1 )
+            os.remove( os.path.join(self.path, 'index') )
+        with Link360Archive( self.path, mode='a' ) as archive:
+            self.assertEqual( len(archive), 0 )
+            archive.reindex()
+            self.assertEqual( len(archive), 1500 )
+            for i in [ 0, 777, 1499 ]:
+                self.assertEqual( archive.get('id=pmid:%s' % i), SAMPLE_XML % str(i).encode('utf-8') )
+
+
+class TestOpenURL( unittest.TestCase ):
+    """ Checks OpenURL parsing and 0.1 upconversion; no 360Link request needed. """
+
+    def test_matches_parse_qs(self):
+        for ourl in [ 'id=pmid:19282400&sid=Entrez:PubMed', 'title=Organic%20Letters&date=2008&title=&x', SAMPLE_DATA['echoedQuery']['queryString'] ]:
+            self.assertEqual( parse_openurl(ourl).params, parse_qs(ourl) )
+
+    def test_upconvert(self):
+        context = parse_openurl( 'id=pmid:19282400&id=doi%3A&sid=Entrez:PubMed&genre=book&title=The+risk+pool&aulast=Russo' )
+        self.assertEqual( context.version, '0.1' )
+        self.assertEqual( context.identifiers, ['info:pmid/19282400'] )
+        self.assertEqual( context.referrer, ['info:sid/Entrez:PubMed'] )
+        self.assertEqual( context.format, 'info:ofi/fmt:kev:mtx:book' )
+        self.assertEqual( context.referent['btitle'], ['The risk pool'] )
+        kev = parse_qs( context.kev() )
+        self.assertEqual( kev['url_ver'], ['Z39.88-2004'] )
+        self.assertEqual( kev['rft.aulast'], ['Russo'] )
+        self.assertEqual( kev['title'], ['The risk pool'] )  # original keys are kept
+
+    def test_1_0_not_upconverted(self):
+        """ A WorldCat 1.0 lookup keeps its format for 360Link to decide, and gets no added keys. """
+        ourl = 'rft_id=info:oclcnum/17803510&sid=FirstSearch:WorldCat&url_ver=Z39.88-2004&title=The+risk+pool'
+        context = parse_openurl( ourl )
+        self.assertEqual( context.version, '1.0' )
+        self.assertEqual( context.format, None )
+        self.assertEqual( context.referrer, [] )
+        self.assertEqual( parse_qs(context.kev()), parse_qs(ourl) )
+        self.assertEqual( parse_openurl('ctx_ver=Z39.88-2004&genre=book').version, '1.0' )
+
+    def test_no_genre_no_format(self):
+        context = parse_openurl( 'title=The+risk+pool&aulast=Russo' )
+        self.assertEqual( context.format, None )
+        self.assertEqual( context.referent['title'], ['The risk pool'] )
+        self.assertFalse( 'rft_val_fmt' in parse_qs(context.kev()) )
+
+    def test_request_url(self):
+        """ The query goes to 360Link as given, followed by what 0.1 upconversion adds. """
+        ourl = 'id=pmid:19282400&sid=Entrez:PubMed&aulast=M%FCller&isbn=&x'
+        url = _sersol_url( '?' + ourl, 'abc123' )
+        self.assertTrue( url.startswith('http://abc123.openurl.xml.serialssolutions.com/openurlxml?version=1.0&' + ourl + '&') )
+        added = parse_qs( url.split(ourl + '&', 1)[1] )
+        self.assertEqual( added, {'url_ver': ['Z39.88-2004'], 'rft_id': ['info:pmid/19282400'], 'rfr_id': ['info:sid/Entrez:PubMed']} )  # no mangled rft.aulast
+        #A 1.0 query with url_ver goes out untouched.
+        ourl = 'url_ver=Z39.88-2004&rft_id=info:oclcnum/17803510&sid=FirstSearch:WorldCat'
+        self.assertTrue( _sersol_url(ourl, 'abc123').endswith('version=1.0&' + ourl) )
+
+    def test_upconverted_echo(self):
+        """ An echoed, upconverted 0.1 query passes on its sid, not the added rfr_id too. """
+        data = json.loads( json.dumps(SAMPLE_DATA) )
+        data['echoedQuery']['queryString'] = 'id=pmid:19282400&sid=Entrez:PubMed&url_ver=Z39.88-2004&rft_id=info%3Apmid%2F19282400&rfr_id=info%3Asid%2FEntrez%3APubMed'
+        pairs = Resolved( data ).openurl_pairs()
+        self.assertEqual( [ (key, val) for (key, val) in pairs if key in ('sid', 'rfr_id') ], [('sid', ['Entrez:PubMed'])] )
+
+    def test_resolved_query_dict(self):
+        sersol = Resolved( SAMPLE_DATA )
+        self.assertEqual( sersol.query_dict, parse_qs(SAMPLE_DATA['echoedQuery']['queryString']) )
+        sersol.query_dict['sid'].append( 'changed' )
+        self.assertEqual( sersol.context.params['sid'], ['FirstSearch:WorldCat'] )
+        self.assertEqual( sersol._retain_ourl_params(), [('rfe_dat', ['<accessionnumber>17803510</accessionnumber>']), ('sid', ['FirstSearch:WorldCat'])] )
+
+    def test_referent_is_a_copy(self):
+        context = parse_openurl( 'url_ver=Z39.88-2004&rft.atitle=One' )
+        context.referent['atitle'].append( 'Two' )
+        self.assertEqual( context.params['rft.atitle'], ['One'] )
+        self.assertEqual( parse_qs(context.kev())['rft.atitle'], ['One'] )
 
 if __name__ == '__main__':
     unittest.main()